@@ -1,7 +1,20 @@
-from flask import Flask, jsonify, request, send_from_directory
+from concurrent.futures import ThreadPoolExecutor
+from filelock import FileLock
+from flask import Flask, jsonify, request, send_file, send_from_directory
 from pathlib import Path
 from datetime import datetime
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import atexit
+import contextlib
+import functools
+import io
+import os
+import re
+import threading
+import time
 import uuid
 
 # Serve files from the folder that contains this script
@@ -10,43 +23,132 @@ app = Flask(__name__, static_folder=str(BASE), static_url_path='')
 
 DATA_DIR = BASE / 'data'
 FIX_FILE = DATA_DIR / 'Test Fixture Location_final.xlsx'
-BORROW_FILE = DATA_DIR / 'borrowed_test_fixtures.xlsx'
+# Borrow log: a Parquet dataset directory, one part file per write.
+# The old Excel log is imported once when the directory doesn't exist yet.
+BORROW_DIR = DATA_DIR / 'borrowed_test_fixtures'
+BORROW_XLSX = DATA_DIR / 'borrowed_test_fixtures.xlsx'
+BORROW_COLUMNS = [
+    'borrow_id','Article','Part Number','System','Quantity',
+    'Client Name','Client Phone','Location',
+    'Borrowed At','Returned At'
+]
+BORROW_SCHEMA = pa.schema([(c, pa.int64() if c == 'Quantity' else pa.string()) for c in BORROW_COLUMNS])
+
+# Text columns are held as Arrow-backed strings: .str ops and == run in Arrow
+# kernels over one buffer per column instead of per Python object.
+_ARROW_STR = pd.StringDtype('pyarrow')
+_ARROW_TYPES = {pa.string(): _ARROW_STR}.get
+
+# What an empty log reads as; served without touching disk on a fresh install
+_EMPTY_BORROW = BORROW_SCHEMA.empty_table().to_pandas(types_mapper=_ARROW_TYPES)
+
+# Parsed data plus lookups derived from it, keyed on the file's (or the
+# borrow directory's) mtime so edits on disk are picked up.
+#   qty:       {(Article, system): Excel qty}
+#   locations: {(Article, system): distinct locations, in sheet order}
+#   parts:     {Article: Part Number of its first row}
+#   open_qty:  {(Article, System): quantity currently borrowed}
+_FIX_CACHE = {'mtime': None, 'df': None, 'qty': None, 'locations': None, 'parts': None}
+_BORROW_CACHE = {'mtime': None, 'df': None, 'open_qty': None}
+
+# New borrows are buffered here and appended to the log by a single background
+# writer thread, so /api/borrow doesn't wait on disk. Rows that pile up while a
+# write is in flight go out together in the next append.
+# _BORROW_LOCK guards the buffer and every write to BORROW_DIR. Writers, and
+# readers refreshing _BORROW_CACHE, also take _BORROW_FILE_LOCK so another process
+# on the same log never sees a compaction half done. The buffer and the
+# availability check live in this process, so the app is served from one process.
+_pending_borrows: list = []
+_BORROW_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix='borrow-writer')
+_BORROW_LOCK = threading.RLock()
+_BORROW_FILE_LOCK = FileLock(DATA_DIR / 'borrowed_test_fixtures.lock')
+# Bumped on every write to BORROW_DIR; the directory mtime can't tell apart two
+# writes within one timestamp tick on coarse filesystems
+_borrow_version = 0
+
+_FIX_TEXT_COLUMNS = ('Article', 'Part Number', 'Name', 'Fixture Type', 'Fixture Description', 'Location')
+
+# System rules, first match wins: (substring, column it's looked for in, label).
+# Rows matching none fall back to their Fixture Type, or 'OTHER' if that's empty.
+_SYS_RULES = (
+    ('VSFT',  'ft',   'VSFT'),
+    ('VSICT', 'ft',   'VSICT'),
+    ('SAFT',  'ft',   'SAFT'),
+    ('SPEA',  'desc', 'SPEA3030'),
+)
+
+# Request validation for /api/borrow
+_QTY_RE = re.compile(r'[+-]?\d+')
+# Leading separators can't be digits, so a failing match stays linear
+_PHONE_RE = re.compile(r'\+?[ ()/-]*\d[\d ()/-]*')
+_PHONE_MAX_LEN = 32
 
 # ---------- Data helpers ----------
-def load_fixtures():
+def _fixture_cache():
     """
     Excel:
       Sheet name: 'Fixtures'
-      First row is the real header row.
+      The sheet's first row is blank; the real header is the second row.
       Key columns: Article, Part Number, Name, Fixture Type, Fixture Description, Location, Available Units (Qty.)
+
+    Returns the parsed frame ('df') and the lookups built from it, cached until the
+    file changes; callers must not mutate them.
     """
-    xls = pd.ExcelFile(FIX_FILE)
-    df = xls.parse('Fixtures')
-    header = df.iloc[0].tolist()
-    df = df.iloc[1:].copy()
-    df.columns = header
+    global _FIX_CACHE
+    mtime = FIX_FILE.stat().st_mtime_ns
+    cache = _FIX_CACHE
+    if cache['mtime'] == mtime:
+        return cache
+
+    # Text columns are read straight into Arrow strings, skipping inference.
+    # The qty column holds stray text ('-', '5*4') so it still goes through to_numeric.
+    df = pd.read_excel(FIX_FILE, sheet_name='Fixtures', header=1, engine='openpyxl',
+                       dtype={c: _ARROW_STR for c in _FIX_TEXT_COLUMNS},
+                       engine_kwargs={'read_only': True, 'data_only': True})
 
     # Normalize
-    df['Article'] = df['Article'].astype(str).str.strip()
-    df['Fixture Type'] = df['Fixture Type'].astype(str).str.strip()
-    if 'Fixture Description' in df.columns:
-        df['Fixture Description'] = df['Fixture Description'].astype(str)
+    df['Article'] = df['Article'].str.strip()
+    df['Fixture Type'] = df['Fixture Type'].str.strip()
+    # Blank display cells come back as '' rather than <NA>
+    shown = [c for c in ('Part Number', 'Name', 'Fixture Type', 'Fixture Description') if c in df.columns]
+    df[shown] = df[shown].fillna('')
     if 'Available Units (Qty.)' in df.columns:
         df['Available Units (Qty.)'] = pd.to_numeric(
             df['Available Units (Qty.)'], errors='coerce'
         ).fillna(0).astype(int)
     else:
         df['Available Units (Qty.)'] = 0
-    return df
 
-def system_label(row):
-    ft = (row.get('Fixture Type') or '').upper()
-    desc = (row.get('Fixture Description') or '').upper()
-    if 'VSFT' in ft: return 'VSFT'
-    if 'VSICT' in ft: return 'VSICT'
-    if 'SAFT' in ft: return 'SAFT'
-    if 'SPEA' in desc: return 'SPEA3030'
-    return ft or 'OTHER'
+    # System label per row from _SYS_RULES, evaluated once per load instead of per request
+    text = {
+        'ft': df['Fixture Type'].fillna('').str.upper(),
+        'desc': (df['Fixture Description'].fillna('').str.upper()
+                 if 'Fixture Description' in df.columns else pd.Series('', index=df.index)),
+    }
+    df['_system'] = np.select(
+        [text[src].str.contains(needle, regex=False) for needle, src, _ in _SYS_RULES],
+        [label for _, _, label in _SYS_RULES],
+        default=text['ft'].where(text['ft'] != '', 'OTHER'))
+
+    # Few distinct values across many rows: categories make the equality filters int compares
+    df['Article'] = df['Article'].astype('category')
+    df['_system'] = df['_system'].astype('category')
+
+    qty = df.groupby(['Article', '_system'], observed=True)['Available Units (Qty.)'].sum()
+    if 'Location' in df.columns:
+        locations = (df.dropna(subset=['Location'])
+                     .groupby(['Article', '_system'], observed=True)['Location']
+                     .apply(lambda s: list(dict.fromkeys(s.astype(str))))
+                     .to_dict())
+    else:
+        locations = {}
+    first = df.dropna(subset=['Article']).drop_duplicates('Article')
+    parts = dict(zip(first['Article'], first['Part Number'])) if 'Part Number' in df.columns else {}
+
+    # Publish with a single rebind: request threads read this without a lock, and
+    # filling the old dict key by key would let them see a new mtime with old indexes
+    _FIX_CACHE = {'mtime': mtime, 'df': df, 'qty': qty.to_dict(), 'locations': locations, 'parts': parts}
+    return _FIX_CACHE
 
 def ensure_borrow_schema(df: pd.DataFrame) -> pd.DataFrame:
     """
@@ -55,11 +157,7 @@ def ensure_borrow_schema(df: pd.DataFrame) -> pd.DataFrame:
       Client Name, Client Phone, Location,
       Borrowed At, Returned At
     """
-    columns = [
-        'borrow_id','Article','Part Number','System','Quantity',
-        'Client Name','Client Phone','Location',
-        'Borrowed At','Returned At'
-    ]
+    columns = BORROW_COLUMNS
     for c in columns:
         if c not in df.columns:
             df[c] = pd.NA
@@ -70,39 +168,186 @@ def ensure_borrow_schema(df: pd.DataFrame) -> pd.DataFrame:
             df = df.drop(columns=[c])
     # Reorder
     df = df[columns]
-    return df
+    # Coerce Quantity once here so readers can sum it directly
+    return df.assign(Quantity=pd.to_numeric(df['Quantity'], errors='coerce').fillna(0).astype('int64'))
 
 def load_borrow():
-    if not BORROW_FILE.exists():
-        cols = [
-            'borrow_id','Article','Part Number','System','Quantity',
-            'Client Name','Client Phone','Location',
-            'Borrowed At','Returned At'
-        ]
-        pd.DataFrame(columns=cols).to_excel(BORROW_FILE, index=False)
-    df = pd.read_excel(BORROW_FILE)
-    return ensure_borrow_schema(df)
+    """Borrow log as a DataFrame, including rows still buffered in _pending_borrows."""
+    with _BORROW_LOCK:
+        df = _borrow_cache()['df']
+        if not _pending_borrows:
+            # Routes mutate the borrow frame before saving, so hand out a copy
+            return df.copy()
+        # Built under BORROW_SCHEMA so the buffered rows carry the same dtypes as the log
+        pending = pa.Table.from_pylist(_pending_borrows, schema=BORROW_SCHEMA).to_pandas(types_mapper=_ARROW_TYPES)
+        return pd.concat([df, pending], ignore_index=True)
+
+def _borrow_cache():
+    if not BORROW_DIR.exists():
+        _create_borrow_log()
+
+    if _BORROW_CACHE['mtime'] == BORROW_DIR.stat().st_mtime_ns:
+        return _BORROW_CACHE
+
+    # save_borrow() writes the compacted part before unlinking the old ones; reading
+    # under the writers' lock keeps us from picking up both, or a part mid-unlink
+    with _BORROW_FILE_LOCK:
+        mtime = BORROW_DIR.stat().st_mtime_ns
+        if not any(BORROW_DIR.glob('part-*.parquet')):
+            _BORROW_CACHE['mtime'] = mtime
+            _BORROW_CACHE['df'] = _EMPTY_BORROW
+            _BORROW_CACHE['open_qty'] = {}
+            return _BORROW_CACHE
+        df = pq.read_table(BORROW_DIR, schema=BORROW_SCHEMA).to_pandas(types_mapper=_ARROW_TYPES)
+
+    # A compaction that died before unlinking the old parts leaves every row in
+    # twice; the compacted part sorts last, so keep its copy of each borrow_id
+    df = df[df['borrow_id'].isna() | ~df.duplicated('borrow_id', keep='last')].reset_index(drop=True)
+
+    open_ = df[df['Returned At'].isna()]
+    used = open_['Quantity'].groupby([open_['Article'], open_['System'].str.upper()]).sum()
+
+    _BORROW_CACHE['mtime'] = mtime
+    _BORROW_CACHE['df'] = df
+    _BORROW_CACHE['open_qty'] = used.to_dict()
+    return _BORROW_CACHE
+
+def _create_borrow_log():
+    """Create BORROW_DIR, seeded from the legacy Excel log if there is one."""
+    if not BORROW_XLSX.exists():
+        # An empty directory is an empty log; no seed part needed
+        BORROW_DIR.mkdir(parents=True, exist_ok=True)
+        return
+    seed = ensure_borrow_schema(pd.read_excel(BORROW_XLSX))
+    # Build it under a temp name so a half-created log is never picked up
+    tmp = BORROW_DIR.with_name(f'_{BORROW_DIR.name}-{uuid.uuid4().hex}')
+    tmp.mkdir(parents=True)
+    pq.write_table(_borrow_table(seed), tmp / 'part-0.parquet')
+    try:
+        os.rename(tmp, BORROW_DIR)
+    except OSError:
+        # Another worker got there first
+        for f in tmp.iterdir():
+            f.unlink()
+        tmp.rmdir()
+
+def _borrow_table(df: pd.DataFrame) -> pa.Table:
+    """Coerce an ensure_borrow_schema() frame to BORROW_SCHEMA (strings everywhere but Quantity)."""
+    out = {}
+    for c in BORROW_COLUMNS:
+        col = df[c]
+        out[c] = col if c == 'Quantity' else col.where(col.isna(), col.astype(str))
+    return pa.Table.from_pandas(pd.DataFrame(out), schema=BORROW_SCHEMA, preserve_index=False)
+
+def _write_borrow_part(table: pa.Table):
+    # '_'-prefixed files are skipped by readers, so the part only appears once complete.
+    # Readers load parts in path order; the timestamp keeps that the write order.
+    name = f'{time.time_ns():020d}-{uuid.uuid4().hex}'
+    tmp = BORROW_DIR / f'_{name}.parquet'
+    pq.write_table(table, tmp)
+    os.replace(tmp, BORROW_DIR / f'part-{name}.parquet')
+
+def open_borrow_qty() -> dict:
+    """{(Article, System): quantity currently borrowed}, counting buffered rows too."""
+    with _BORROW_LOCK:
+        open_qty = _borrow_cache()['open_qty']
+        if not _pending_borrows:
+            return open_qty
+        open_qty = dict(open_qty)
+        for r in _pending_borrows:
+            key = (r['Article'], r['System'])
+            open_qty[key] = open_qty.get(key, 0) + r['Quantity']
+        return open_qty
+
+@contextlib.contextmanager
+def _borrow_writer():
+    """Exclusive write access to the borrow log, across threads and processes."""
+    with _BORROW_LOCK, _BORROW_FILE_LOCK:
+        yield
 
 def save_borrow(df: pd.DataFrame):
-    ensure_borrow_schema(df).to_excel(BORROW_FILE, index=False)
-
-def availability(df: pd.DataFrame, article: str, system: str) -> int:
-    """Available = Excel qty minus currently-open borrows for that article+system."""
-    sys_norm = (system or '').upper()
-    base = df[(df['Article'] == str(article)) & (df.apply(system_label, axis=1).str.upper() == sys_norm)]
-    base_qty = int(base['Available Units (Qty.)'].sum()) if not base.empty else 0
-
-    bor = load_borrow()
-    if bor.empty:
-        return base_qty
+    """Replace the whole log with df, compacted into a single part file."""
+    global _borrow_version
+    with _borrow_writer():
+        old = list(BORROW_DIR.glob('part-*.parquet'))
+        _BORROW_CACHE['mtime'] = None
+        _borrow_version += 1
+        _write_borrow_part(_borrow_table(ensure_borrow_schema(df)))
+        for f in old:
+            f.unlink()
+
+def append_borrows(rows: list):
+    """Append borrow rows to the log as a new part file; existing parts are left untouched."""
+    global _borrow_version
+    _borrow_cache()  # creates the log on first use
+    _BORROW_CACHE['mtime'] = None
+    _borrow_version += 1
+    _write_borrow_part(pa.Table.from_pylist(rows, schema=BORROW_SCHEMA))
+
+def record_borrow(new: dict):
+    """Buffer a borrow row and queue it for the background writer; returns immediately."""
+    with _BORROW_LOCK:
+        _pending_borrows.append(new)
+    _BORROW_WRITER.submit(_flush_in_background)
+
+def _flush_in_background():
+    try:
+        flush_borrows()
+    except Exception:
+        # Rows stay buffered and go out with the next flush
+        app.logger.exception('Writing buffered borrows failed')
+
+def flush_borrows():
+    """Write all buffered borrow rows to the log in a single append."""
+    with _borrow_writer():
+        if _pending_borrows:
+            append_borrows(_pending_borrows)
+            _pending_borrows.clear()
+
+def mark_returned(borrow_ids, now: str):
+    """Stamp 'Returned At' on the open rows with these borrow_ids."""
+    ids = set(borrow_ids)
+    with _borrow_writer():
+        # Re-read inside the lock so parts appended by another process aren't compacted away
+        flush_borrows()
+        bor = _borrow_cache()['df'].copy()
+        bor.loc[bor['borrow_id'].isin(ids) & bor['Returned At'].isna(), 'Returned At'] = now
+        save_borrow(bor)
+
+def availability(qty: dict, open_qty: dict, article: str, system: str) -> int:
+    """
+    Available = Excel qty minus currently-open borrows for that article+system.
+    Routes fetch the 'qty' / 'open_qty' indexes once and pass them to every call.
+    """
+    key = (str(article), (system or '').upper())
+    return int(max(qty.get(key, 0) - open_qty.get(key, 0), 0))
 
-    mask_open = (
-        (bor['Article'].astype(str) == str(article)) &
-        (bor['System'].astype(str).str.upper() == sys_norm) &
-        (bor['Returned At'].isna())
-    )
-    used = int(pd.to_numeric(bor.loc[mask_open, 'Quantity'], errors='coerce').fillna(0).sum()) if mask_open.any() else 0
-    return max(base_qty - used, 0)
+def _data_version() -> tuple:
+    """
+    (fixtures mtime, borrow log write count, buffered borrow count): changes whenever
+    anything the read routes depend on does, so it can key their memoized results.
+    """
+    with _BORROW_LOCK:
+        return (FIX_FILE.stat().st_mtime_ns, _borrow_version, len(_pending_borrows))
+
+def _text(data: dict, key: str) -> str:
+    return str(data.get(key) or '').strip()
+
+def _parse_qty(raw) -> int:
+    """Whole-number quantity from JSON (int, integral float or numeric string); 0 if invalid."""
+    if isinstance(raw, bool):
+        return 0
+    if isinstance(raw, int):
+        return raw
+    if isinstance(raw, float):
+        return int(raw) if raw.is_integer() else 0
+    if isinstance(raw, str) and _QTY_RE.fullmatch(raw.strip()):
+        try:
+            return int(raw)
+        except (TypeError, ValueError):
+            # e.g. more digits than int() will convert
+            return 0
+    return 0
 
 # ---------- Routes ----------
 @app.route('/')
@@ -120,46 +365,56 @@ def api_search():
     article = request.args.get('article', '').strip()
     if not article:
         return jsonify(found=False, error="Missing article"), 400
+    return jsonify(_search_core(article, *_data_version()))
 
-    df = load_fixtures()
+@functools.lru_cache(maxsize=512)
+def _search_core(article: str, fix_mtime: int, bor_version: int, pending: int) -> dict:
+    """api_search payload; the trailing args are only the _data_version() cache key."""
+    fix = _fixture_cache()
+    df, base_qty = fix['df'], fix['qty']
+    open_qty = open_borrow_qty()
 
     # exact first
-    sub = df[df['Article'].astype(str).str.fullmatch(str(article))]
+    sub = df[df['Article'] == article]
     if sub.empty:
-        # fallback: contains
-        sub = df[df['Article'].astype(str).str.contains(str(article), na=False)]
-
-        uniq_articles = sub['Article'].dropna().astype(str).unique().tolist()
-        if len(uniq_articles) > 1:
-            choices = (sub[['Article', 'Part Number', 'Name']]
-                       .astype(str)
-                       .drop_duplicates()
-                       .head(20)
-                       .to_dict(orient='records'))
-            return jsonify(found='multiple', choices=choices)
+        # fallback: contains (plain substring, tested once per distinct article)
+        cats = df['Article'].cat.categories
+        sub = df[df['Article'].isin(cats[cats.str.contains(article, regex=False)])]
+
+        if sub['Article'].nunique() > 1:
+            # First 20 distinct (Article, Part Number, Name) rows; all three are already strings
+            cols = ('Article', 'Part Number', 'Name')
+            choices, seen = [], set()
+            for key in sub[list(cols)].itertuples(index=False, name=None):
+                if key not in seen:
+                    seen.add(key)
+                    choices.append(dict(zip(cols, key)))
+                    if len(choices) == 20:
+                        break
+            return {'found': 'multiple', 'choices': choices}
 
     if sub.empty:
-        return jsonify(found=False)
+        return {'found': False}
 
     row0 = sub.iloc[0]
     chosen_article = str(row0.get('Article', ''))
 
     # Dynamic systems present (no hardcoded list)
-    systems_present = sorted(set(sub.apply(system_label, axis=1).tolist()))
+    systems_present = sorted(set(sub['_system'].tolist()))
 
     systems_payload = []
     for s in systems_present:
-        avail = availability(df, chosen_article, s)
+        avail = availability(base_qty, open_qty, chosen_article, s)
         if avail > 0:
             systems_payload.append({'system': s, 'available_units': avail})
 
-    return jsonify(
-        found=True,
-        article=chosen_article,
-        part_number=str(row0.get('Part Number','')),
-        name=str(row0.get('Name','')),
-        systems=systems_payload
-    )
+    return {
+        'found': True,
+        'article': chosen_article,
+        'part_number': str(row0.get('Part Number','')),
+        'name': str(row0.get('Name','')),
+        'systems': systems_payload
+    }
 
 @app.get('/api/details')
 def api_details():
@@ -172,18 +427,24 @@ def api_details():
     if not article or not system:
         return jsonify(error='Missing params'), 400
 
-    sys_norm = system.upper()
-    df = load_fixtures()
-    sub = df[(df['Article'].astype(str) == article) &
-             (df.apply(system_label, axis=1).str.upper() == sys_norm)]
+    payload, status = _details_core(article, system.upper(), *_data_version())
+    return jsonify(payload), status
+
+@functools.lru_cache(maxsize=512)
+def _details_core(article: str, sys_norm: str, fix_mtime: int, bor_version: int, pending: int) -> tuple:
+    """(api_details payload, HTTP status); the trailing args are only the _data_version() cache key."""
+    fix = _fixture_cache()
+    df, base_qty = fix['df'], fix['qty']
+    open_qty = open_borrow_qty()
+    sub = df[(df['Article'] == article) & (df['_system'] == sys_norm)]
     if sub.empty:
-        return jsonify(error='Not found'), 404
+        return {'error': 'Not found'}, 404
 
-    avail = availability(df, article, sys_norm)
-    locations = sub['Location'].dropna().astype(str).unique().tolist() if 'Location' in sub.columns else []
+    avail = availability(base_qty, open_qty, article, sys_norm)
+    locations = fix['locations'].get((article, sys_norm), [])
     row = sub.iloc[0]
 
-    return jsonify({
+    return {
         'article': article,
         'part_number': str(row.get('Part Number','')),
         'name': str(row.get('Name','')),
@@ -192,46 +453,37 @@ def api_details():
         'locations': locations,
         'primary_location': locations[0] if locations else '',
         'description': str(row.get('Fixture Description',''))
-    })
+    }, 200
 
 @app.post('/api/borrow')
 def api_borrow():
     """
     Body: { article, system, quantity, client_name, client_phone, location }
-    Writes a row to borrowed_test_fixtures.xlsx and enforces availability.
+    Records a row in the borrow log and enforces availability.
     """
     data = request.get_json(force=True, silent=True) or {}
-    article = str(data.get('article','')).strip()
-    system  = str(data.get('system','')).strip()
-    loc     = str(data.get('location','')).strip()
-    qty_raw = data.get('quantity', 1)
-    try:
-        qty = int(qty_raw)
-    except Exception:
-        qty = 0
-    client_name  = str(data.get('client_name','')).strip()
-    client_phone = str(data.get('client_phone','')).strip()
+    article = _text(data, 'article')
+    system  = _text(data, 'system')
+    loc     = _text(data, 'location')
+    qty     = _parse_qty(data.get('quantity', 1))
+    client_name  = _text(data, 'client_name')
+    client_phone = _text(data, 'client_phone')
 
     if not (article and system and qty > 0 and client_name and client_phone):
         return jsonify(ok=False, error='Missing required fields'), 400
+    if len(client_phone) > _PHONE_MAX_LEN or not _PHONE_RE.fullmatch(client_phone):
+        return jsonify(ok=False, error='Invalid client phone'), 400
 
-    df = load_fixtures()
-    if qty > availability(df, article, system):
-        return jsonify(ok=False, error='Not enough units available'), 400
+    sys_norm = system.upper()
+    fix = _fixture_cache()
 
     # enrich part number
-    sub = df[df['Article'].astype(str) == article]
-    part = str(sub.iloc[0].get('Part Number','')) if not sub.empty else ''
+    part = str(fix['parts'].get(article, ''))
 
     # Default location to primary for that system if none provided
     if not loc:
-        sys_norm = system_label(sub.iloc[0]) if not sub.empty else system.upper()
-        sub_sys = sub[sub.apply(system_label, axis=1).str.upper() == sys_norm]
-        loc = (sub_sys['Location'].dropna().astype(str).iloc[0]
-               if ('Location' in sub_sys.columns and not sub_sys.empty and not sub_sys['Location'].dropna().empty)
-               else '')
+        loc = next(iter(fix['locations'].get((article, sys_norm), [])), '')
 
-    bor = load_borrow()
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     bid = str(uuid.uuid4())
     new = {
@@ -239,18 +491,21 @@ def api_borrow():
         'Article': article,
         'Part Number': part,
         # Keep System internally to keep per-system availability correct
-        'System': system.upper(),
+        'System': sys_norm,
         'Quantity': qty,
         'Client Name': client_name,
         'Client Phone': client_phone,
         'Location': loc,
         'Borrowed At': now,
-        'Returned At': pd.NaT
+        'Returned At': None
     }
-    bor = pd.concat([bor, pd.DataFrame([new])], ignore_index=True)
-    save_borrow(bor)
+    # Check and record under one lock so concurrent requests can't both take the last unit
+    with _BORROW_LOCK:
+        if qty > availability(fix['qty'], open_borrow_qty(), article, sys_norm):
+            return jsonify(ok=False, error='Not enough units available'), 400
+        record_borrow(new)
     return jsonify(ok=True, borrow_id=bid, article=article, part_number=part,
-                   system=system.upper(), quantity=qty, location=loc, timestamp=now)
+                   system=sys_norm, quantity=qty, location=loc, timestamp=now)
 
 @app.post('/api/return')
 def api_return():
@@ -273,13 +528,12 @@ def api_return():
         return jsonify(ok=False, error='No borrow records'), 404
 
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    mask = bor['borrow_id'].astype(str).isin(ids) & (bor['Returned At'].isna())
+    mask = bor['borrow_id'].isin(ids) & (bor['Returned At'].isna())
     updated_count = int(mask.sum())
     if updated_count == 0:
         return jsonify(ok=False, error='No open borrows matched those IDs'), 404
 
-    bor.loc[mask, 'Returned At'] = now
-    save_borrow(bor)
+    mark_returned(bor.loc[mask, 'borrow_id'], now)
     return jsonify(ok=True, returned=updated_count, timestamp=now, borrow_ids=ids)
 
 # Add the new API endpoint for returning books using phone number and part number
@@ -304,8 +558,8 @@ def api_return_by_phone_part():
 
     # Find open borrows matching phone number and part number
     mask = (
-        (bor['Client Phone'].astype(str).str.strip() == client_phone) & 
-        (bor['Part Number'].astype(str).str.strip() == part_number) & 
+        (bor['Client Phone'].str.strip() == client_phone) & 
+        (bor['Part Number'].str.strip() == part_number) & 
         (bor['Returned At'].isna())
     )
     
@@ -314,19 +568,32 @@ def api_return_by_phone_part():
         return jsonify(ok=False, error='No open borrows found for this phone number and part number'), 404
 
     # Get the borrow IDs to return
-    ids = matching_records['borrow_id'].astype(str).tolist()
+    ids = matching_records['borrow_id'].tolist()
     
     # Update the records
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    bor.loc[mask, 'Returned At'] = now
-    save_borrow(bor)
+    mark_returned(ids, now)
     
     return jsonify(ok=True, returned=len(ids), timestamp=now, borrow_ids=ids)
 
+@app.get('/api/export.xlsx')
+def api_export_xlsx():
+    """Borrow log rendered as an Excel workbook on demand (it is stored as Parquet)."""
+    buf = io.BytesIO()
+    load_borrow().to_excel(buf, index=False)
+    buf.seek(0)
+    return send_file(buf, as_attachment=True, download_name='borrowed_test_fixtures.xlsx',
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
 # Fallback to serve static files (index.html in same folder)
 @app.route('/<path:path>')
 def static_forward(path):
     return send_from_directory(str(BASE), path)
 
+# Don't lose buffered borrows on shutdown
+atexit.register(flush_borrows)
+
 if __name__ == '__main__':
-    app.run(host='127.0.0.1', port=5000, debug=True)
+    # Threaded WSGI server instead of the single-request dev server; see README for gunicorn
+    from waitress import serve
+    serve(app, host='127.0.0.1', port=5000, threads=8)